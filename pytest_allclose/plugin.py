@@ -1,11 +1,65 @@
 """The ``allclose`` fixture definition."""
 
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import math
+import os
+import queue
+import sys
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
 
 import numpy as np
 import pytest
 
 
+def pytest_addoption(parser):
+    parser.getgroup("allclose").addoption(
+        "--allclose-log",
+        metavar="PATH",
+        help="Write a JSON record for each allclose comparison to the given file",
+    )
+    parser.addini(
+        "allclose_reference_size",
+        help="Maximum size (in bytes) of references kept in memory by "
+        "the allclose_reference fixture",
+        default=str(2**28),
+    )
+    parser.addini(
+        "allclose_reference_disk",
+        type="bool",
+        help="Whether the allclose_reference fixture also caches references "
+        "in the pytest cache directory",
+        default=True,
+    )
+
+
+def pytest_configure(config):
+    path = config.getoption("allclose_log")
+    if path is None:
+        return
+
+    workerinput = getattr(config, "workerinput", None)
+    if workerinput is None:
+        # remove pytest-xdist worker logs left over from previous runs
+        for worker_path in glob.glob(glob.escape(path) + ".gw*"):
+            os.remove(worker_path)
+    else:
+        # each pytest-xdist worker writes a separate log, merged at the end
+        path = "%s.%s" % (path, workerinput["workerid"])
+
+    config.pluginmanager.register(
+        _AllcloseLog(path, merge=workerinput is None), "allclose_log"
+    )
+
+
 def _add_common_docs(func):
     func.__doc__ += """
     Parameters
@@ -30,6 +84,8 @@ def _add_common_docs(func):
         Whether to record the RMSE value for this comparison. Defaults to True.
         Set to False whenever ``a`` and ``b`` should be far apart
         (when ensuring two signals are sufficiently different, for example).
+        If ``a`` or ``b`` contain non-finite values, the RMSE over the elements
+        where both are finite is recorded instead, as ``rmse_finite``.
 
     Returns
     -------
@@ -45,6 +101,20 @@ def allclose(request):
     """
     Returns a function checking if two arrays are close, mimicking `numpy.allclose`.
 
+    The returned function also has a ``defer`` method, taking the same arguments,
+    which runs the comparison on a background thread and immediately returns a
+    handle. The handle evaluates to the comparison result when used as a boolean
+    (blocking until it is available). Inputs are copied when the comparison
+    starts, so the test may modify them afterwards, unless neither they nor the
+    memory they view can be modified (e.g. read-only memory maps). Pending
+    comparisons are joined when the fixture is torn down, and any failing (or
+    raising) comparisons whose result was never checked cause the test to error,
+    listing the call sites of the failures.
+
+    The ``stream`` method takes the same arguments other than ``a`` and ``b``,
+    and returns an `.AllcloseStream` that compares arrays chunk by chunk (along
+    the first axis), without keeping the whole arrays in memory.
+
     .. currentmodule:: allclose
 
     .. function:: _allclose(a, b, rtol=1e-5, atol=1e-8, xtol=0, equal_nan=False, \
@@ -54,6 +124,31 @@ def allclose(request):
 
     overrides = _get_allclose_overrides(request)
     call_count = [0]
+    log = request.config.pluginmanager.get_plugin("allclose_log")
+    log_count = [0]
+    deferred = []
+    executor = [None]
+
+    def _record(comparison, index, a, b, kwargs, prefix=""):
+        result, properties, failures, n_failures = comparison
+
+        request.node.user_properties.extend(properties)
+        if failures is not None:
+            print(prefix + failures)
+
+        if log is not None:
+            log.write(
+                _log_record(
+                    request.node.nodeid,
+                    index,
+                    a,
+                    b,
+                    kwargs,
+                    result,
+                    dict(properties).get("rmse"),
+                    n_failures,
+                )
+            )
 
     @_add_common_docs
     def _allclose(
@@ -68,64 +163,856 @@ def allclose(request):
     ):
         """Checks if two arrays are close, mimicking `numpy.allclose`."""
 
-        if len(overrides) > 0:
-            override_args = overrides[min(call_count[0], len(overrides) - 1)]
-            atol = override_args.get("atol", atol)
-            rtol = override_args.get("rtol", rtol)
-            xtol = override_args.get("xtol", xtol)
-            equal_nan = override_args.get("equal_nan", equal_nan)
-            print_fail = override_args.get("print_fail", print_fail)
-            record_rmse = override_args.get("record_rmse", record_rmse)
-            call_count[0] += 1
+        kwargs = _apply_overrides(
+            overrides,
+            call_count,
+            rtol=rtol,
+            atol=atol,
+            xtol=xtol,
+            equal_nan=equal_nan,
+            print_fail=print_fail,
+            record_rmse=record_rmse,
+        )
+        comparison = _compare(a, b, **kwargs)
+        _record(comparison, log_count[0], a, b, kwargs)
+        log_count[0] += 1
+
+        return comparison[0]
+
+    def _defer(
+        a,
+        b,
+        rtol=1e-5,
+        atol=1e-8,
+        xtol=0,
+        equal_nan=False,
+        print_fail=5,
+        record_rmse=True,
+    ):
+        """Starts an allclose comparison on a background thread.
+
+        Takes the same arguments as ``allclose``, and returns a `.DeferredAllclose`
+        handle for the pending comparison.
+        """
+
+        # tolerance overrides are resolved now, so that they apply in call order
+        kwargs = _apply_overrides(
+            overrides,
+            call_count,
+            rtol=rtol,
+            atol=atol,
+            xtol=xtol,
+            equal_nan=equal_nan,
+            print_fail=print_fail,
+            record_rmse=record_rmse,
+        )
+
+        # the comparison runs concurrently with the test, which may modify its inputs
+        a, b = _snapshot(a), _snapshot(b)
+
+        if executor[0] is None:
+            executor[0] = ThreadPoolExecutor(thread_name_prefix="allclose")
+
+        frame = traceback.extract_stack(limit=2)[0]
+        call_site = "%s:%d" % (frame.filename, frame.lineno)
+        index = log_count[0]
+        log_count[0] += 1
+
+        handle = DeferredAllclose(
+            executor[0].submit(_compare, a, b, **kwargs),
+            lambda comparison: _record(
+                comparison, index, a, b, kwargs, prefix=call_site + "\n"
+            ),
+            call_site=call_site,
+        )
+        deferred.append(handle)
+        return handle
+
+    def _stream(
+        rtol=1e-5,
+        atol=1e-8,
+        xtol=0,
+        equal_nan=False,
+        print_fail=5,
+        record_rmse=True,
+    ):
+        """Starts an incremental allclose comparison.
+
+        Takes the same arguments as ``allclose`` (other than ``a`` and ``b``), and
+        returns an `.AllcloseStream` to which chunks of ``a`` and ``b`` are added.
+        """
+
+        kwargs = _apply_overrides(
+            overrides,
+            call_count,
+            rtol=rtol,
+            atol=atol,
+            xtol=xtol,
+            equal_nan=equal_nan,
+            print_fail=print_fail,
+            record_rmse=record_rmse,
+        )
+        index = log_count[0]
+        log_count[0] += 1
+
+        return AllcloseStream(
+            lambda comparison, a, b: _record(comparison, index, a, b, kwargs),
+            **kwargs,
+        )
+
+    _allclose.defer = _defer
+    _allclose.stream = _stream
+
+    yield _allclose
+
+    if executor[0] is not None:
+        executor[0].shutdown(wait=True)
+
+    failed = _resolve_deferred(deferred)
+    if len(failed) > 0:
+        pytest.fail(
+            "%d deferred allclose comparison(s) failed:\n  %s"
+            % (len(failed), "\n  ".join(failed)),
+            pytrace=False,
+        )
+
+
+def _snapshot(x):
+    """Returns a copy of ``x``, unless it is an array that cannot be modified."""
+    if isinstance(x, np.ndarray):
+        return x if _is_readonly(x) else x.copy()
+
+    # copy pandas and xarray objects with their labels
+    pd = sys.modules.get("pandas")
+    xr = sys.modules.get("xarray")
+    pd_types = () if pd is None else (pd.Series, pd.DataFrame)
+    xr_types = () if xr is None else (xr.DataArray, xr.Dataset)
+    if isinstance(x, pd_types + xr_types):
+        return x.copy(deep=True)
+
+    return np.array(x)
+
+
+def _is_readonly(x):
+    # read-only views of writeable memory (e.g. from ``np.broadcast_to``) can still
+    # change, so every array in the ``base`` chain must be read-only
+    while isinstance(x, np.ndarray):
+        if isinstance(x, np.memmap) and x.mode == "r":
+            return True
+        if x.flags.writeable:
+            return False
+        x = x.base
+
+    return x is None
+
+
+def _resolve_deferred(deferred):
+    """
+    Resolves every deferred handle, so that all comparisons are recorded.
+
+    Returns the call sites of the failed (or raising) comparisons that the test
+    has not checked.
+    """
+
+    failed = []
+    for handle in deferred:
+        try:
+            passed = handle._resolve()
+        except Exception as e:  # pylint: disable=broad-except
+            # exceptions from checked handles have already been raised in the test
+            if not handle.checked:
+                error = traceback.format_exception_only(type(e), e)[-1].strip()
+                failed.append("%s (%s)" % (handle.call_site, error))
+        else:
+            if not passed and not handle.checked:
+                failed.append(handle.call_site)
+
+    return failed
+
+
+class DeferredAllclose:
+    """
+    Handle for an ``allclose`` comparison running on a background thread.
+
+    Returned by ``allclose.defer``. Using the handle as a boolean (e.g. in an
+    ``assert``) blocks until the comparison is complete and returns its result.
+
+    Attributes
+    ----------
+    call_site : str
+        The file and line number where the comparison was started.
+    checked : bool
+        Whether the result of the comparison has been requested.
+    """
+
+    def __init__(self, future, record, call_site):
+        self._future = future
+        self._record = record
+        self._recorded = False
+        self.call_site = call_site
+        self.checked = False
+
+    def __bool__(self):
+        return bool(self.result())
+
+    def __repr__(self):
+        return "<%s at %s (%s)>" % (
+            type(self).__name__,
+            self.call_site,
+            "done" if self.done() else "pending",
+        )
+
+    def done(self):
+        """Whether the comparison has finished."""
+        return self._future.done()
+
+    def result(self):
+        """Blocks until the comparison has finished and returns its result."""
+        self.checked = True
+        return self._resolve()
+
+    def _resolve(self):
+        comparison = self._future.result()
+
+        # record outputs on the test thread, and only once
+        if not self._recorded:
+            self._recorded = True
+            self._record(comparison)
+
+        return comparison[0]
+
+
+class AllcloseStream:
+    """
+    Incremental ``allclose`` comparison of arrays produced in chunks.
+
+    Returned by ``allclose.stream``. Chunks of ``a`` and ``b`` are added with
+    `.update`, and `.result` returns the same result as calling ``allclose`` on
+    the concatenation of all chunks (along the first axis). The recorded RMSEs
+    are also the same, up to floating-point rounding.
+
+    Only the last ``2 * xtol`` rows of ``a`` and ``b`` are kept between updates,
+    along with running sums for the RMSEs and the first ``print_fail`` failures.
+    """
+
+    def __init__(self, record, rtol, atol, xtol, equal_nan, print_fail, record_rmse):
+        self._record = record
+        self._tols = dict(rtol=rtol, atol=atol, equal_nan=equal_nan)
+        self.xtol = xtol
+        self.print_fail = print_fail
+        self.record_rmse = record_rmse
+
+        # rows of ``a`` and ``b`` (and their finiteness masks) kept from previous
+        # chunks, starting at row ``_start``
+        self._a = None
+        self._b = None
+        self._a_finite = None
+        self._b_finite = None
+        self._start = 0
+        self._n_rows = 0
+        self._n_decided = 0
+
+        # running ``(sum of squares, size)`` for ``a - b``, ``a``, ``b``,
+        # and the finite elements of ``a - b``
+        self._sums = [[0.0, 0], [0.0, 0], [0.0, 0], [0.0, 0]]
+        self._diffs = []
+        self._n_failures = 0
+        self._result = None
+
+    def update(self, a, b):
+        """Adds the next chunk of ``a`` and ``b`` to the comparison."""
+
+        if self._result is not None:
+            raise RuntimeError("Cannot update a finished allclose stream")
 
         a = np.atleast_1d(a)
         b = np.atleast_1d(b)
+        a_finite, b_finite = _finite(a), _finite(b)
+        if self.record_rmse:
+            for sums, (rms, size) in zip(
+                self._sums, _rms_stats(a, b, a_finite, b_finite)
+            ):
+                if size > 0:
+                    sums[0] += rms**2 * size
+                    sums[1] += size
+
+        a, b = np.broadcast_arrays(a, b)
+        a_finite, b_finite = (
+            (
+                np.ones(a.shape, dtype=bool)
+                if mask is None
+                else np.broadcast_to(mask, a.shape)
+            )
+            for mask in (a_finite, b_finite)
+        )
+        if self._a is not None:
+            a = np.concatenate([self._a, a])
+            b = np.concatenate([self._b, b])
+            a_finite = np.concatenate([self._a_finite, a_finite])
+            b_finite = np.concatenate([self._b_finite, b_finite])
+        self._a, self._b = a, b
+        self._a_finite, self._b_finite = a_finite, b_finite
+        self._n_rows = self._start + len(a)
+
+        # rows within ``xtol`` of the end depend on future chunks
+        if self._n_rows - self.xtol > self._n_decided:
+            self._decide(self._n_decided, self._n_rows - self.xtol)
+
+        # keep only the rows needed to compare the undecided rows, copied so that
+        # they neither change with the caller's buffers nor keep the whole chunk alive
+        keep = max(self._n_decided - self.xtol, self._start)
+        self._a, self._b, self._a_finite, self._b_finite = (
+            np.array(x[keep - self._start :], copy=True)
+            for x in (self._a, self._b, self._a_finite, self._b_finite)
+        )
+        self._start = keep
+
+    def result(self):
+        """Finishes the comparison, returning whether the arrays are close."""
+
+        if self._result is None:
+            # the last ``xtol`` rows are assumed close, as in ``allclose``
+            self._result = self._n_failures == 0
 
-        rmse = _safe_rms(a - b)
-        if record_rmse and not np.any(np.isnan(rmse)):
-            request.node.user_properties.append(("rmse", rmse))
+            properties = []
+            if self.record_rmse:
+                properties = _rmse_properties(
+                    [
+                        ((total / size) ** 0.5 if size > 0 else np.nan, size)
+                        for total, size in self._sums
+                    ]
+                )
 
-            ab_rms = _safe_rms(a) + _safe_rms(b)
-            rmse_relative = (2 * rmse / ab_rms) if ab_rms > 0 else np.nan
-            if not np.any(np.isnan(rmse_relative)):
-                request.node.user_properties.append(("rmse_relative", rmse_relative))
+            failures = None
+            if self.print_fail > 0 and not self._result:
+                failures = "allclose first %d failures:\n  %s" % (
+                    len(self._diffs),
+                    "\n  ".join(self._diffs),
+                )
 
-        close = np.isclose(a, b, rtol=rtol, atol=atol, equal_nan=equal_nan)
+            # zero-memory stand-ins with the shape and dtype of the full arrays
+            if self._a is None:
+                a = b = np.zeros(0)
+            else:
+                a, b = (
+                    np.broadcast_to(
+                        np.zeros((), dtype=x.dtype), (self._n_rows,) + x.shape[1:]
+                    )
+                    for x in (self._a, self._b)
+                )
+            self._record((self._result, properties, failures, self._n_failures), a, b)
 
-        # if xtol > 0, check that number of adjacent positions. If they are
-        # close, then we consider things close.
-        for i in range(1, xtol + 1):
-            close[i:] |= np.isclose(
-                a[i:], b[:-i], rtol=rtol, atol=atol, equal_nan=equal_nan
+        return self._result
+
+    def _decide(self, start, stop):
+        """Computes which of the rows ``start`` to ``stop`` are close."""
+
+        a, b, xtol = self._a, self._b, self.xtol
+        close = np.ones((stop - start,) + a.shape[1:], dtype=bool)
+
+        # the first ``xtol`` rows are assumed close, as in ``allclose``
+        first = max(start, xtol)
+        if first < stop:
+            a_finite, b_finite = (
+                None if mask.all() else mask
+                for mask in (self._a_finite, self._b_finite)
             )
-            close[:-i] |= np.isclose(
-                a[:-i], b[i:], rtol=rtol, atol=atol, equal_nan=equal_nan
+            isclose = _isclose_rows(a, b, a_finite, b_finite, **self._tols)
+
+            rows = slice(first - self._start, stop - self._start)
+            close_rows = isclose(rows, rows)
+            for i in range(1, xtol + 1):
+                for shift in (-i, i):
+                    shifted = slice(rows.start + shift, rows.stop + shift)
+                    close_rows |= isclose(rows, shifted)
+            close[first - start :] = close_rows
+
+        self._n_failures += close.size - np.count_nonzero(close)
+        for ind in zip(*(~close).nonzero()):
+            if len(self._diffs) >= self.print_fail:
+                break
+            local = (ind[0] + start - self._start,) + ind[1:]
+            self._diffs.append(
+                "%s: %s %s" % ((ind[0] + start,) + ind[1:], a[local], b[local])
             )
 
-            # we assume that the beginning and end of the array are close
-            # (since we're comparing to entries outside the bounds of
-            # the other array)
-            close[[i - 1, -i]] = True
+        self._n_decided = stop
+
+
+@pytest.fixture(scope="session")
+def allclose_reference(request):
+    """
+    Returns a function computing reference arrays, memoised across tests.
+
+    Calling ``allclose_reference(func, *args, **kwargs)`` returns the result of
+    ``func(*args, **kwargs)`` as a read-only array, only calling ``func`` if the
+    result is not already cached. This is useful when parametrized tests compare
+    against the same expensive reference computation.
 
-        result = np.all(close)
+    Results are keyed by a hash of ``func`` (its source code, default arguments,
+    closure variables, and the values of the global variables it uses) and of the
+    arguments. ``func`` must be a Python function or a `functools.partial` of one,
+    and the arguments (as well as any default, partial, and closure values) must be
+    arrays, numbers, strings, ``None``, or (nested) lists, tuples, and dicts of
+    these. Global variables with other values (such as modules, functions, and
+    classes) are not hashed. Recent results are kept in memory, up to a total size
+    set by the ``allclose_reference_size`` option (in bytes). Unless the
+    ``allclose_reference_disk`` option is False, results are also stored in the
+    pytest cache directory, so they can be shared between runs and between
+    ``pytest-xdist`` workers. Clear them with ``pytest --cache-clear``.
 
-        if print_fail > 0 and not result:
-            diffs = []
+    Cached results are *not* invalidated by changes to
+
+    - other functions called by ``func`` (or the global variables they use),
+    - global variables that are not hashed (including attributes of modules or
+      other objects used by ``func``),
+    - installed packages (e.g. the version of NumPy), or
+    - any other state read by ``func``, such as files or environment variables.
+
+    .. currentmodule:: allclose_reference
+
+    .. function:: _allclose_reference(func, *args, **kwargs)
+       :noindex:
+    """
+
+    max_bytes = int(request.config.getini("allclose_reference_size"))
+    cache_dir = None
+    if (
+        request.config.getini("allclose_reference_disk")
+        and getattr(request.config, "cache", None) is not None
+    ):
+        cache = request.config.cache
+        mkdir = cache.mkdir if hasattr(cache, "mkdir") else cache.makedir
+        cache_dir = str(mkdir("allclose_reference"))
+
+    memory = OrderedDict()
+    memory_bytes = [0]
+
+    def _allclose_reference(func, *args, **kwargs):
+        """Returns ``func(*args, **kwargs)`` as a read-only array, memoised."""
+
+        key = _hash_reference(func, args, kwargs)
+
+        if key in memory:
+            memory.move_to_end(key)
+            return memory[key].view()
+
+        path = None if cache_dir is None else os.path.join(cache_dir, key + ".npy")
+        if path is not None and os.path.exists(path):
+            # memory-mapped read-only, so the data is not copied into memory
+            value = np.load(path, mmap_mode="r")
+        else:
+            value = func(*args, **kwargs)
+            if not (
+                isinstance(value, np.ndarray)
+                and value.base is None
+                and not value.flags.writeable
+            ):
+                # store a private copy, so that the cached reference does not change
+                # with the returned array (which may be e.g. a buffer ``func`` reuses)
+                value = np.array(value)
+            value.flags.writeable = False
+            if path is not None and value.dtype != object:
+                _save_atomic(path, value)
+
+        if value.nbytes <= max_bytes:
+            memory[key] = value
+            memory_bytes[0] += value.nbytes
+            while memory_bytes[0] > max_bytes:
+                _, evicted = memory.popitem(last=False)
+                memory_bytes[0] -= evicted.nbytes
+
+        return value.view()
+
+    return _allclose_reference
+
+
+def _compare(a, b, rtol, atol, xtol, equal_nan, print_fail, record_rmse):
+    """
+    Compares two arrays.
+
+    Returns the result, the RMSE properties to record, a printable description of
+    the first ``print_fail`` failures (or None), and the number of failing elements.
+    """
+
+    fields = _labelled_fields(a, b)
+    if fields is None:
+        fields = [(None, np.atleast_1d(a), np.atleast_1d(b), None)]
+
+    # finiteness masks and ``a - b`` are computed once, and used for both closeness
+    # and the RMSEs
+    finite = [(_finite(a_field), _finite(b_field)) for _, a_field, b_field, _ in fields]
+    diffs = [_diff(a_field, b_field) for _, a_field, b_field, _ in fields]
+
+    # ``_isclose`` may replace ``diffs`` with their absolute values in-place
+    closes = [
+        _isclose(a_field, b_field, rtol, atol, xtol, equal_nan, *masks, diff=diff)
+        for (_, a_field, b_field, _), masks, diff in zip(fields, finite, diffs)
+    ]
+
+    properties = _field_rmses(fields, finite, diffs) if record_rmse else []
+
+    n_failures = sum(close.size - np.count_nonzero(close) for close in closes)
+    result = n_failures == 0
+
+    failures = None
+    if print_fail > 0 and not result:
+        diffs = []
+        for (_, a_field, b_field, labels), close in zip(fields, closes):
             # broadcast a and b to have same shape as close for indexing
-            broadcast_a = a + np.zeros(b.shape, dtype=a.dtype)
-            broadcast_b = b + np.zeros(a.shape, dtype=b.dtype)
-            for k, ind in enumerate(zip(*(~close).nonzero())):
-                if k >= print_fail:
+            broadcast_a = a_field + np.zeros(b_field.shape, dtype=a_field.dtype)
+            broadcast_b = b_field + np.zeros(a_field.shape, dtype=b_field.dtype)
+            for ind in zip(*(~close).nonzero()):
+                if len(diffs) >= print_fail:
                     break
-                diffs.append("%s: %s %s" % (ind, broadcast_a[ind], broadcast_b[ind]))
+                label = ind if labels is None else labels(ind)
+                diffs.append("%s: %s %s" % (label, broadcast_a[ind], broadcast_b[ind]))
+
+        failures = "allclose first %d failures:\n  %s" % (
+            len(diffs),
+            "\n  ".join(diffs),
+        )
+
+    return result, properties, failures, n_failures
+
+
+def _field_rmses(fields, finite, diffs):
+    """Returns the RMSE properties for the given fields, and for all of them."""
+
+    properties = []
+    rms_stats = []
+    for (name, a_field, b_field, _), masks, diff in zip(fields, finite, diffs):
+        if isinstance(name, list):
+            # a block of columns, with RMSEs for each column along the first axis
+            stats = _rms_stats(a_field, b_field, *masks, diff=diff, axis=0)
+            properties.extend(_field_rmse_properties(name, stats))
+            stats = [_combine_rms(rms, size) for rms, size in stats]
+        else:
+            stats = _rms_stats(a_field, b_field, *masks, diff=diff)
+            if name is not None:
+                properties.extend(_field_rmse_properties([name], stats))
+        rms_stats.append(stats)
+
+    if len(rms_stats) == 1:
+        stats = rms_stats[0]
+    else:
+        stats = [_combine_rms(*zip(*field_stats)) for field_stats in zip(*rms_stats)]
+    return _rmse_properties(stats) + properties
+
+
+def _isclose(a, b, rtol, atol, xtol, equal_nan, a_finite, b_finite, diff=None):
+    isclose = _isclose_rows(a, b, a_finite, b_finite, rtol, atol, equal_nan)
+    close = isclose(slice(None), slice(None), diff=diff)
+
+    # if xtol > 0, check that number of adjacent positions. If they are
+    # close, then we consider things close.
+    for i in range(1, xtol + 1):
+        close[i:] |= isclose(slice(i, None), slice(None, -i))
+        close[:-i] |= isclose(slice(None, -i), slice(i, None))
 
-            print(
-                "allclose first %d failures:\n  %s" % (len(diffs), "\n  ".join(diffs))
+        # we assume that the beginning and end of the array are close
+        # (since we're comparing to entries outside the bounds of
+        # the other array)
+        close[[i - 1, -i]] = True
+
+    return close
+
+
+def _finite(x):
+    """Returns a mask of the finite values in ``x``, or None if all are finite."""
+    if x.dtype.kind not in "fc":
+        return None
+
+    finite = np.isfinite(x)
+    return None if finite.all() else finite
+
+
+def _isclose_rows(a, b, a_finite, b_finite, rtol, atol, equal_nan, chunk_size=2**14):
+    """
+    Returns a function comparing slices (along the first axis) of two arrays.
+
+    ``isclose(a_rows, b_rows)`` is equivalent to
+    ``np.isclose(a[a_rows], b[b_rows], rtol, atol, equal_nan)``, but uses the
+    finiteness masks from `._finite` rather than recomputing them. The comparison is
+    done in chunks of ``chunk_size`` elements, so no temporary arrays the size of
+    the inputs are allocated.
+
+    If given, ``diff`` must be ``a[a_rows] - b[b_rows]``, and is replaced by its
+    absolute value in-place.
+    """
+
+    # like ``np.isclose``, so that ``abs(a - b)`` does not overflow
+    b = _as_inexact(b)
+
+    # complex infinities cannot be matched with ``==``, so use ``np.isclose``
+    if a.dtype.kind not in "biuf" or b.dtype.kind != "f":
+        return lambda a_rows, b_rows, diff=None: np.isclose(
+            a[a_rows], b[b_rows], rtol=rtol, atol=atol, equal_nan=equal_nan
+        )
+
+    def isclose(a_rows, b_rows, diff=None):
+        a_part, b_part = a[a_rows], b[b_rows]
+        shape = np.broadcast(a_part, b_part).shape
+        parts = [
+            None if x is None else np.broadcast_to(x, shape)
+            for x in (
+                a_part,
+                b_part,
+                None if a_finite is None else a_finite[a_rows],
+                None if b_finite is None else b_finite[b_rows],
+            )
+        ]
+
+        # chunk along the slowest-varying axis (e.g. columns of pandas blocks)
+        if a_part.ndim > 1 and abs(a_part.strides[0]) < abs(a_part.strides[-1]):
+            close = np.empty(shape[::-1], dtype=bool).T
+            parts = [None if x is None else x.T for x in [close, diff] + parts]
+        else:
+            close = np.empty(shape, dtype=bool)
+            parts = [close, diff] + parts
+
+        rows = max(chunk_size // max(int(np.prod(parts[0].shape[1:])), 1), 1)
+        buffer_shape = (min(rows, len(parts[0])),) + parts[0].shape[1:]
+        tol_buffer = np.empty(buffer_shape, dtype=b.dtype)
+        diff_buffer = None
+        if diff is None:
+            diff_buffer = np.empty(buffer_shape, dtype=np.result_type(a, b))
+
+        with np.errstate(invalid="ignore", over="ignore"):
+            for i in range(0, len(parts[0]), rows):
+                _isclose_chunk(
+                    *(None if x is None else x[i : i + rows] for x in parts),
+                    tol_buffer=tol_buffer,
+                    diff_buffer=diff_buffer,
+                    rtol=rtol,
+                    atol=atol,
+                    equal_nan=equal_nan,
+                )
+
+        return close
+
+    return isclose
+
+
+def _isclose_chunk(
+    close,
+    diff,
+    a,
+    b,
+    a_finite,
+    b_finite,
+    tol_buffer,
+    diff_buffer,
+    rtol,
+    atol,
+    equal_nan,
+):
+    """Computes the closeness of one chunk of `._isclose_rows` into ``close``."""
+
+    n = len(close)
+    if diff is None:
+        diff = np.subtract(a, b, out=diff_buffer[:n])
+    np.abs(diff, out=diff)
+    tol = np.abs(b, out=tol_buffer[:n])
+    tol *= rtol
+    tol += atol
+    np.less_equal(diff, tol, out=close)
+
+    if b_finite is not None:
+        # an infinite ``b`` has an infinite tolerance
+        close &= b_finite
+    if a_finite is not None and b_finite is not None:
+        # values that are non-finite in both arrays are only close if they are
+        # matching infinities (or NaNs, with ``equal_nan``)
+        nonfinite = ~(a_finite | b_finite)
+        if nonfinite.any():
+            close |= a == b
+            if equal_nan:
+                close |= nonfinite & (a != a) & (b != b)
+
+
+def _labelled_fields(a, b):
+    """
+    Splits pandas or xarray inputs into aligned fields (columns or variables).
+
+    Returns None if neither input is a pandas or xarray object. Otherwise, returns
+    a list of ``(name, a, b, labels)`` tuples, where ``a`` and ``b`` are arrays
+    (views of the underlying data, where possible) and ``labels`` maps an index
+    into these arrays to the corresponding labels. DataFrames whose columns all
+    have the same dtype are returned as a single 2-D field, with a list of the
+    column names as ``name``.
+    """
+
+    # only check for types from libraries that have already been imported
+    pd = sys.modules.get("pandas")
+    xr = sys.modules.get("xarray")
+    pd_types = () if pd is None else (pd.Series, pd.DataFrame)
+    xr_types = () if xr is None else (xr.DataArray, xr.Dataset)
+
+    if isinstance(a, pd_types) or isinstance(b, pd_types):
+        a, b = _align_pandas(pd, a, b)
+        index = a.index
+        if isinstance(a, pd.Series):
+            return [
+                (
+                    None,
+                    _pandas_values(a),
+                    _pandas_values(b),
+                    lambda ind: _format_labels([index[ind[0]]]),
+                )
+            ]
+
+        columns = a.columns
+        if _homogeneous(a) and _homogeneous(b):
+            # compare all columns at once, as a (rows, columns) block
+            return [
+                (
+                    list(columns),
+                    a.to_numpy(),
+                    b.to_numpy(),
+                    lambda ind: _format_labels([index[ind[0]], columns[ind[1]]]),
+                )
+            ]
+
+        # mixed or extension dtypes are compared column by column
+        return [
+            (
+                column,
+                _pandas_values(a.iloc[:, j]),
+                _pandas_values(b.iloc[:, j]),
+                lambda ind, column=column: _format_labels([index[ind[0]], column]),
+            )
+            for j, column in enumerate(columns)
+        ]
+
+    if isinstance(a, xr_types) or isinstance(b, xr_types):
+        a, b = _align_xarray(xr, a, b)
+        if isinstance(a, xr.DataArray):
+            return [
+                (
+                    None,
+                    np.atleast_1d(a.values),
+                    np.atleast_1d(b.values),
+                    _xarray_labels(a),
+                )
+            ]
+
+        return [
+            (
+                name,
+                np.atleast_1d(a[name].values),
+                np.atleast_1d(b[name].transpose(*a[name].dims).values),
+                _xarray_labels(a[name]),
             )
+            for name in a.data_vars
+        ]
 
-        return result
+    return None
 
-    return _allclose
+
+def _align_pandas(pd, a, b):
+    for x, y in ((a, b), (b, a)):
+        if isinstance(x, (pd.Series, pd.DataFrame)) and isinstance(y, pd.DataFrame):
+            if not isinstance(x, pd.DataFrame):
+                raise TypeError("Cannot compare a pandas Series with a DataFrame")
+
+    # give unlabelled inputs the labels of the other input
+    if not isinstance(a, (pd.Series, pd.DataFrame)):
+        a = _pandas_like(pd, a, b)
+    if not isinstance(b, (pd.Series, pd.DataFrame)):
+        b = _pandas_like(pd, b, a)
+
+    aligned = a.index.equals(b.index)
+    if isinstance(a, pd.DataFrame):
+        aligned = aligned and a.columns.equals(b.columns)
+
+    # only realign (which copies) if labels do not match. Labels missing from
+    # one input are filled with NaN, so they will fail the comparison.
+    return (a, b) if aligned else a.align(b, join="outer")
+
+
+def _pandas_like(pd, x, like):
+    x = np.broadcast_to(x, like.shape)
+    if isinstance(like, pd.Series):
+        return pd.Series(x, index=like.index, copy=False)
+    return pd.DataFrame(x, index=like.index, columns=like.columns, copy=False)
+
+
+def _homogeneous(frame):
+    # whether all columns have the same NumPy dtype, so that ``to_numpy`` returns a
+    # view of a single block without converting
+    dtypes = set(frame.dtypes)
+    return len(dtypes) == 1 and isinstance(dtypes.pop(), np.dtype)
+
+
+def _pandas_values(series):
+    if isinstance(series.dtype, np.dtype):
+        return series.to_numpy()
+
+    # extension dtypes (e.g. nullable integers) need converting, with NA as NaN
+    return series.to_numpy(dtype=float, na_value=np.nan)
+
+
+def _align_xarray(xr, a, b):
+    if not isinstance(a, (xr.DataArray, xr.Dataset)):
+        a = _xarray_like(xr, a, b)
+    if not isinstance(b, (xr.DataArray, xr.Dataset)):
+        b = _xarray_like(xr, b, a)
+
+    if isinstance(a, xr.DataArray) != isinstance(b, xr.DataArray):
+        raise TypeError("Cannot compare an xarray DataArray with a Dataset")
+    if isinstance(a, xr.Dataset) and set(a.data_vars) != set(b.data_vars):
+        raise ValueError(
+            "Datasets have different data variables (%s and %s)"
+            % (sorted(a.data_vars), sorted(b.data_vars))
+        )
+
+    try:
+        # does not copy data, but raises if coordinates differ
+        a, b = xr.align(a, b, join="exact")
+    except ValueError:
+        # coordinates missing from one input are filled with NaN,
+        # so they will fail the comparison
+        a, b = xr.align(a, b, join="outer")
+
+    if isinstance(a, xr.DataArray):
+        b = b.transpose(*a.dims)
+    return a, b
+
+
+def _xarray_like(xr, x, like):
+    if not isinstance(like, xr.DataArray):
+        raise TypeError("Cannot compare an xarray Dataset with an unlabelled array")
+    return xr.DataArray(
+        np.broadcast_to(x, like.shape), coords=like.coords, dims=like.dims
+    )
+
+
+def _xarray_labels(da):
+    def labels(ind):
+        return _format_labels(
+            [
+                da.indexes[dim][i] if dim in da.indexes else i
+                for dim, i in zip(da.dims, ind)
+            ]
+        )
+
+    return labels
+
+
+def _format_labels(labels):
+    return "[%s]" % ", ".join(str(label) for label in labels)
+
+
+def _apply_overrides(overrides, call_count, **kwargs):
+    """Applies the configured tolerance overrides for the current call."""
+
+    if len(overrides) > 0:
+        override_args = overrides[min(call_count[0], len(overrides) - 1)]
+        kwargs = {k: override_args.get(k, v) for k, v in kwargs.items()}
+        call_count[0] += 1
+
+    return kwargs
 
 
 _allclose_arg_types = {
@@ -138,13 +1025,349 @@ _allclose_arg_types = {
 }
 
 
+class _AllcloseLog:
+    """Writes JSON records to a file from a background thread."""
+
+    def __init__(self, path, merge):
+        self.path = path
+        self.merge = merge
+        self._queue = queue.Queue()
+        self._file = open(path, "w", encoding="utf-8")
+        self._thread = threading.Thread(
+            target=self._run, name="allclose-log", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def pytest_sessionfinish(self, session):
+        self.close()
+
+        if self.merge:
+            # append (and remove) logs written by pytest-xdist workers
+            with open(self.path, "a", encoding="utf-8") as f:
+                for worker_path in sorted(glob.glob(glob.escape(self.path) + ".gw*")):
+                    with open(worker_path, encoding="utf-8") as worker_file:
+                        for line in worker_file:
+                            f.write(line)
+                    os.remove(worker_path)
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self._file.write(
+                json.dumps(record, separators=(",", ":"), default=_json_default)
+            )
+            self._file.write("\n")
+
+
+def _log_record(nodeid, index, a, b, kwargs, result, rmse, n_failures):
+    (a_shape, a_dtype), (b_shape, b_dtype) = _describe(a), _describe(b)
+    return {
+        "nodeid": nodeid,
+        "index": index,
+        "shape": [a_shape, b_shape],
+        "dtype": [a_dtype, b_dtype],
+        "tolerances": kwargs,
+        "passed": bool(result),
+        "rmse": None if rmse is None or np.isnan(rmse) else rmse,
+        "n_failures": int(n_failures),
+    }
+
+
+def _describe(x):
+    """Returns the shape and dtype of an array-like, for logging."""
+    if hasattr(x, "data_vars"):  # xarray Dataset
+        return list(x.sizes.values()), type(x).__name__
+    if hasattr(x, "dtypes"):  # pandas DataFrame
+        return list(x.shape), ",".join(sorted(set(str(dt) for dt in x.dtypes)))
+    if not hasattr(x, "dtype"):
+        x = np.asarray(x)
+    return list(x.shape), str(x.dtype)
+
+
+def _json_default(x):
+    return x.item() if isinstance(x, np.generic) else str(x)
+
+
 def _rms(x, axis=None, keepdims=False):
     return np.sqrt(np.mean(x**2, axis=axis, keepdims=keepdims))
 
 
-def _safe_rms(x):
+def _safe_rms(x, axis=None):
     x = np.asarray(x)
-    return _rms(x).item() if x.size > 0 else np.nan
+    if axis is None:
+        return _rms(x).item() if x.size > 0 else np.nan
+    return _rms(x, axis=axis) if x.shape[axis] > 0 else np.full(x.shape[1:], np.nan)
+
+
+def _rms_stats(a, b, a_finite, b_finite, diff=None, axis=None):
+    """
+    Returns ``(rms, size)`` pairs for ``a - b``, ``a``, ``b``, and finite ``a - b``.
+
+    The finite RMSE only includes elements where both ``a`` and ``b`` are finite.
+    ``diff`` is ``a - b`` (or its absolute value), computed by `._diff` if not given,
+    and is overwritten. If ``axis`` is 0, ``rms`` and ``size`` are arrays with the
+    statistics along the first axis (e.g. for each column of a 2-D block).
+    """
+
+    # booleans cannot be subtracted, and squares of large integers overflow
+    a, b = _as_inexact(a), _as_inexact(b)
+    if diff is None:
+        diff = _diff(a, b)
+    size = diff.size if axis is None else np.full(diff.shape[1:], len(diff))
+
+    if a_finite is None and b_finite is None:
+        rmse = (_safe_rms(diff, axis), size)
+        return rmse, (_safe_rms(a, axis), size), (_safe_rms(b, axis), size), rmse
+
+    shape = np.broadcast(a, b).shape
+    if a_finite is None or b_finite is None:
+        finite = np.broadcast_to(b_finite if a_finite is None else a_finite, shape)
+    else:
+        finite = a_finite & b_finite
+
+    n_finite = np.count_nonzero(finite, axis=axis)
+    sum_sq = _finite_sum_squares(diff, finite, axis=axis)
+    with np.errstate(invalid="ignore"):
+        rmse_finite = np.sqrt(sum_sq / n_finite)
+
+    if axis is None:
+        # RMSEs including non-finite values are not finite, so we skip computing them
+        return (
+            (np.nan, size),
+            (np.nan, a.size),
+            (np.nan, b.size),
+            (rmse_finite.item(), n_finite),
+        )
+
+    # only fields (e.g. columns) with no non-finite values have the other RMSEs
+    nonfinite = n_finite < size
+    with np.errstate(invalid="ignore", over="ignore"):
+        rmse, a_rms, b_rms = (
+            np.where(nonfinite, np.nan, rms)
+            for rms in (
+                rmse_finite,
+                np.sqrt(_sum_squares(a, axis) / size),
+                np.sqrt(_sum_squares(b, axis) / size),
+            )
+        )
+    return (rmse, size), (a_rms, size), (b_rms, size), (rmse_finite, n_finite)
+
+
+def _finite_sum_squares(diff, finite, axis=None, chunk_size=2**16):
+    """
+    Returns the sum of squares of ``diff`` where ``finite`` is True.
+
+    Sums along the first axis if ``axis`` is 0, otherwise over all elements.
+    ``diff`` is overwritten.
+    """
+
+    if diff.dtype.kind != "f" or diff.itemsize not in (2, 4, 8):
+        diff[~finite] = 0
+        return _sum_squares(diff, axis)
+
+    # zero non-finite elements bitwise, since indexing or ``where`` with a (random)
+    # mask is much slower. This is done in chunks (in memory order, e.g. by column
+    # for pandas blocks), to reuse a small mask buffer.
+    order = "F" if diff.flags.f_contiguous and not diff.flags.c_contiguous else "C"
+    flat = diff.ravel(order=order)
+    finite = finite.ravel(order=order)
+    bits = flat.view("u%d" % flat.itemsize)
+    mask = np.empty(min(chunk_size, bits.size), dtype=bits.dtype)
+    sum_sq = 0.0
+    for i in range(0, bits.size, chunk_size):
+        chunk_bits = bits[i : i + chunk_size]
+        chunk_mask = mask[: chunk_bits.size]
+        np.copyto(chunk_mask, finite[i : i + chunk_size])
+        np.negative(chunk_mask, out=chunk_mask)
+        np.bitwise_and(chunk_bits, chunk_mask, out=chunk_bits)
+        if axis is None:
+            chunk = flat[i : i + chunk_size]
+            sum_sq += np.dot(chunk, chunk)
+
+    if axis is None:
+        return sum_sq
+    return _sum_squares(flat.reshape(diff.shape, order=order), axis)
+
+
+def _sum_squares(x, axis=None):
+    if axis is None:
+        x = x.ravel()
+        return np.vdot(x, x).real
+    return np.einsum("i...,i...->...", x.conj() if x.dtype.kind == "c" else x, x).real
+
+
+def _diff(a, b):
+    """Returns ``a - b``, converting booleans and integers to floats."""
+    with np.errstate(invalid="ignore", over="ignore"):
+        return _as_inexact(a) - _as_inexact(b)
+
+
+def _as_inexact(x):
+    return x.astype(np.result_type(x, 1.0)) if x.dtype.kind in "biu" else x
+
+
+def _combine_rms(rms, size):
+    # combine RMS values computed over separate sets of ``size`` elements
+    rms, size = np.asarray(rms, dtype=float), np.asarray(size)
+    nonempty = size > 0
+    total = size.sum().item()
+    if total == 0:
+        return np.nan, 0
+    return np.sqrt(np.sum(rms[nonempty] ** 2 * size[nonempty]) / total).item(), total
+
+
+def _field_rmse_properties(names, stats):
+    # only ``rmse`` (or ``rmse_finite``) is recorded for each field, to limit the
+    # number of properties for inputs with many fields
+    (rmse, _), _, _, (rmse_finite, _) = stats
+
+    properties = []
+    for name, value, finite_value in zip(
+        names, np.ravel(rmse).tolist(), np.ravel(rmse_finite).tolist()
+    ):
+        if not math.isnan(value):
+            properties.append(("rmse[%s]" % (name,), value))
+        elif not math.isnan(finite_value):
+            properties.append(("rmse_finite[%s]" % (name,), finite_value))
+
+    return properties
+
+
+def _rmse_properties(stats, suffix=""):
+    # ``stats`` contains ``(rms, size)`` pairs for ``a - b``, ``a``, ``b``,
+    # and the finite elements of ``a - b``
+    (rmse, _), (a_rms, _), (b_rms, _), (rmse_finite, _) = stats
+
+    properties = []
+    if not np.any(np.isnan(rmse)):
+        properties.append(("rmse" + suffix, rmse))
+
+        ab_rms = a_rms + b_rms
+        rmse_relative = (2 * rmse / ab_rms) if ab_rms > 0 else np.nan
+        if not np.any(np.isnan(rmse_relative)):
+            properties.append(("rmse_relative" + suffix, rmse_relative))
+    elif not np.any(np.isnan(rmse_finite)):
+        properties.append(("rmse_finite" + suffix, rmse_finite))
+
+    return properties
+
+
+def _hash_reference(func, args, kwargs):
+    h = hashlib.sha1()
+    _hash_function(h, func)
+    _hash_update(h, args)
+    _hash_update(h, kwargs)
+    return h.hexdigest()
+
+
+def _hash_function(h, func):
+    if isinstance(func, functools.partial):
+        h.update(b"partial")
+        _hash_function(h, func.func)
+        _hash_update(h, func.args)
+        _hash_update(h, func.keywords)
+        return
+
+    if not inspect.isfunction(func):
+        raise TypeError(
+            "Cannot identify callable of type %r for allclose_reference; use a "
+            "function or functools.partial instead" % type(func).__name__
+        )
+
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        raise TypeError(
+            "Cannot find the source of %r for allclose_reference" % (func,)
+        ) from None
+
+    _hash_update(h, (func.__module__, func.__qualname__, source))
+    _hash_update(h, func.__defaults__)
+    _hash_update(h, func.__kwdefaults__)
+
+    # closures from the same source differ in the values of their free variables
+    for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+        try:
+            contents = cell.cell_contents
+        except ValueError:  # empty cell
+            contents = None
+        _hash_update(h, name)
+        _hash_update(h, contents)
+
+    _hash_globals(h, func)
+
+
+def _hash_globals(h, func):
+    # global variables used by ``func`` (or by functions defined in it), where
+    # their values can be hashed
+    for name in sorted(_code_names(func.__code__)):
+        if name not in func.__globals__:
+            continue
+
+        value_hash = hashlib.sha1()
+        try:
+            _hash_update(value_hash, func.__globals__[name])
+        except TypeError:
+            continue
+        _hash_update(h, name)
+        h.update(value_hash.digest())
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def _hash_update(h, x):
+    # include type names, so that e.g. ``1``, ``1.0`` and ``"1"`` hash differently
+    h.update(type(x).__name__.encode())
+    if isinstance(x, (np.ndarray, np.generic)):
+        x = np.asarray(x)
+        if x.dtype == object:
+            raise TypeError("Cannot hash object arrays for allclose_reference")
+        h.update(("%s%s" % (x.dtype.str, x.shape)).encode())
+        h.update(np.ascontiguousarray(x).tobytes())
+    elif isinstance(x, (list, tuple)):
+        h.update(str(len(x)).encode())
+        for item in x:
+            _hash_update(h, item)
+    elif isinstance(x, dict):
+        h.update(str(len(x)).encode())
+        for k in sorted(x):
+            _hash_update(h, k)
+            _hash_update(h, x[k])
+    elif x is None or isinstance(x, (bool, int, float, complex, str, bytes)):
+        h.update(repr(x).encode())
+    else:
+        raise TypeError(
+            "Cannot hash argument of type %r for allclose_reference" % type(x).__name__
+        )
+
+
+def _save_atomic(path, x):
+    # write to a temporary file first, so that concurrent readers (e.g. other
+    # xdist workers) never see a partially written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, x, allow_pickle=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 def _get_allclose_overrides(request):
@@ -220,8 +1443,16 @@ def report_rmses(terminalreporter, relative=True):
     rmse_name = "rmse_relative" if relative else "rmse"
 
     tr = terminalreporter
+    passed = {report.nodeid: report for report in tr.stats.get("passed", [])}
+
+    # deferred comparisons are joined during teardown, so the (passed) teardown
+    # reports contain the most complete set of recorded properties
+    for report in tr.stats.get("", []):
+        if report.when == "teardown" and report.nodeid in passed:
+            passed[report.nodeid] = report
+
     all_rmses = []
-    for passed_test in tr.stats.get("passed", []):
+    for passed_test in passed.values():
         for name, val in passed_test.user_properties:
             if name == rmse_name:
                 all_rmses.append(val)
@@ -3,10 +3,13 @@
 """Test the allclose fixture."""
 
 import inspect
+import tracemalloc
 
 import numpy as np
 import pytest
 
+from pytest_allclose.plugin import _finite, _isclose, _isclose_rows, _snapshot
+
 
 def eye_vector(n, k, dtype=bool):
     return np.eye(1, n, k=k, dtype=dtype)[0]
@@ -131,3 +134,283 @@ def test_docstring(allclose):
 
     assert "Parameters\n    ----------" in allclose.__doc__
     assert "Returns\n    -------" in allclose.__doc__
+
+
+def test_defer(allclose):
+    rng = np.random.RandomState(8)
+    atol = 1e-5
+    rtol = 1e-3
+
+    pairs = get_vector_pairs(atol, rtol, rng)
+    handles = [allclose.defer(y, x, atol=atol, rtol=rtol) for x, y, _ in pairs]
+    for handle, (_, _, close) in zip(handles, pairs):
+        assert bool(handle) == close
+        assert handle.done() and handle.checked
+
+
+def test_defer_overrides(allclose):
+    # setup.cfg specifies separate first and second tolerances
+    x = np.linspace(-1, 1)
+    handle = allclose.defer(x + 0.005, x)
+    assert not allclose(x + 0.005, x)
+    assert handle
+
+
+def test_defer_snapshot(allclose, tmp_path):
+    x = np.linspace(-1, 1)
+    a = x.copy()
+    handle = allclose.defer(a, x)
+    a += 1
+    assert handle
+
+    assert _snapshot(a) is not a and np.array_equal(_snapshot(a), a)
+    assert np.array_equal(_snapshot(list(x)), x)
+
+    # read-only views of writeable memory are copied
+    view = np.broadcast_to(a, (2,) + a.shape)
+    assert not np.shares_memory(_snapshot(view), a)
+
+    # arrays that cannot be modified are not
+    a.flags.writeable = False
+    view = np.broadcast_to(a, (2,) + a.shape)
+    assert _snapshot(a) is a and _snapshot(view) is view
+    np.save(tmp_path / "x.npy", x)
+    mapped = np.load(tmp_path / "x.npy", mmap_mode="r")
+    assert _snapshot(mapped) is mapped and _snapshot(mapped[1:]).base is mapped
+
+
+def test_pandas(allclose, request, capsys):
+    pd = pytest.importorskip("pandas")
+
+    index = pd.date_range("2020-01-01", periods=5)
+    a = pd.DataFrame({"x": np.arange(5.0), "n": np.arange(5)}, index=index)
+    assert allclose(a, a.copy())
+    assert allclose(a["x"], a["x"].values)
+
+    properties = dict(request.node.user_properties)
+    assert properties["rmse[x]"] == 0 and properties["rmse[n]"] == 0
+
+    # rows are compared by label, not position
+    assert allclose(a, a.iloc[::-1])
+
+    # missing labels fail
+    assert not allclose(a, a.iloc[1:])
+    assert "[2020-01-01 00:00:00, x]: 0.0 nan" in capsys.readouterr().out
+
+    b = a.copy()
+    b.loc[index[2], "n"] = 7
+    assert not allclose(a, b)
+    assert "[2020-01-03 00:00:00, n]: 2 7" in capsys.readouterr().out
+
+    with pytest.raises(TypeError, match="Series with a DataFrame"):
+        allclose(a, a["x"])
+
+    # deferred comparisons copy labelled inputs
+    handle = allclose.defer(b, a)
+    b.loc[index[2], "n"] = 2
+    assert not handle
+    capsys.readouterr()
+
+
+def test_pandas_rmse(allclose, request):
+    pd = pytest.importorskip("pandas")
+
+    rng = np.random.RandomState(9)
+    x = rng.uniform(-1, 1, size=(20, 3))
+    y = x + rng.uniform(-0.01, 0.01, size=x.shape)
+    assert allclose(pd.DataFrame(y), pd.DataFrame(x), atol=0.01)
+    assert allclose(y, x, atol=0.01)
+
+    properties = request.node.user_properties
+    by_column = dict(properties[:-2])
+    by_array = dict(properties[-2:])
+    assert np.allclose(by_column["rmse"], by_array["rmse"])
+    assert np.allclose(by_column["rmse_relative"], by_array["rmse_relative"])
+    for j in range(3):
+        assert np.allclose(
+            by_column["rmse[%d]" % j], np.sqrt(np.mean((y - x)[:, j] ** 2))
+        )
+
+    # columns with non-finite values record their RMSE over finite values
+    y[0, 1] = x[0, 1] = np.nan
+    n_properties = len(properties)
+    assert allclose(pd.DataFrame(y), pd.DataFrame(x), atol=0.01, equal_nan=True)
+    properties = dict(request.node.user_properties[n_properties:])
+    assert "rmse[1]" not in properties
+    assert np.allclose(
+        properties["rmse_finite[1]"], np.sqrt(np.mean((y - x)[1:, 1] ** 2))
+    )
+    assert np.allclose(properties["rmse[2]"], by_column["rmse[2]"])
+
+
+def test_pandas_block_labels(allclose, capsys):
+    pd = pytest.importorskip("pandas")
+
+    a = pd.DataFrame(np.zeros((3, 2)), index=["r0", "r1", "r2"], columns=["x", "y"])
+    b = a.copy()
+    b.loc["r1", "y"] = 1
+    assert not allclose(a, b)
+    assert "[r1, y]: 0.0 1.0" in capsys.readouterr().out
+
+
+def test_pandas_dtypes(allclose, request):
+    pd = pytest.importorskip("pandas")
+
+    a = pd.DataFrame(
+        {"flag": [True, False, True], "n": np.array([3, 3, 3], dtype=np.int64) * 10**9}
+    )
+    assert allclose(a, a.copy())
+    assert allclose(a, a.assign(n=a["n"] + 1), rtol=1e-8)
+
+    b = a.assign(n=0)
+    assert not allclose(a, b, print_fail=0)
+    properties = dict(request.node.user_properties)
+    assert properties["rmse[flag]"] == 0
+    assert properties["rmse[n]"] == 3e9
+    assert np.allclose(properties["rmse"], 3e9 / np.sqrt(2))
+
+
+def test_xarray(allclose, request, capsys):
+    xr = pytest.importorskip("xarray")
+
+    a = xr.DataArray(
+        np.arange(6.0).reshape(2, 3),
+        coords={"t": [0.1, 0.2], "ch": ["a", "b", "c"]},
+        dims=("t", "ch"),
+    )
+    assert allclose(a, a.copy())
+    assert allclose(a.T, a)
+    assert allclose(a.isel(ch=[2, 0, 1]), a)
+    assert allclose(a, a.values)
+
+    b = a.copy()
+    b.loc[{"t": 0.2, "ch": "b"}] = 0
+    assert not allclose(a, b)
+    assert "[0.2, b]: 4.0 0.0" in capsys.readouterr().out
+
+    ds = xr.Dataset({"u": a, "v": 2 * a})
+    assert allclose(ds, ds.copy())
+    assert "rmse[v]" in dict(request.node.user_properties)
+    assert not allclose(ds, ds.assign(v=b))
+
+    with pytest.raises(TypeError, match="Dataset with an unlabelled array"):
+        allclose(ds, a.values)
+
+
+@pytest.mark.parametrize("xtol", [0, 1, 3])
+def test_stream(xtol, allclose, request, capsys):
+    rng = np.random.RandomState(10)
+    x = np.sin(np.linspace(0, 4 * np.pi, 60))[:, None] * np.ones(2)
+    dx = x[1] - x[0]
+
+    for y in (x + 0.001, np.roll(x, xtol, axis=0), x + dx * (x > 0.5)):
+        cuts = np.sort(rng.randint(0, len(x), size=5))
+        stream = allclose.stream(atol=0.002, xtol=xtol, print_fail=3)
+        for a_chunk, b_chunk in zip(np.split(y, cuts), np.split(x, cuts)):
+            stream.update(a_chunk, b_chunk)
+        result = stream.result()
+        assert stream.result() == result
+        stream_output = capsys.readouterr().out
+
+        assert result == allclose(y, x, atol=0.002, xtol=xtol, print_fail=3)
+        assert stream_output == capsys.readouterr().out
+
+        properties = request.node.user_properties
+        n_rmses = len(properties) // 2
+        assert n_rmses in (2, 4)
+        assert np.allclose(
+            [val for _, val in properties[:n_rmses]],
+            [val for _, val in properties[n_rmses:]],
+            rtol=1e-12,
+            atol=0,
+        )
+        del properties[:]
+
+    with pytest.raises(RuntimeError, match="finished allclose stream"):
+        stream.update(x, x)
+
+
+def test_stream_state(allclose):
+    # only a few rows are kept between updates, not the previous chunks
+    stream = allclose.stream(xtol=2)
+    chunk = np.zeros((1000, 100))
+    tracemalloc.start()
+    try:
+        for _ in range(5):
+            stream.update(chunk, chunk.copy())
+            assert tracemalloc.get_traced_memory()[0] < chunk.nbytes / 10
+    finally:
+        tracemalloc.stop()
+    assert stream.result()
+    assert allclose.stream().result()
+
+
+def test_stream_reused_buffers(allclose):
+    x = np.linspace(0, 1, 20)
+    y = np.roll(x, 1)
+    y[0] = x[0]
+    assert allclose(y, x, xtol=1)
+
+    stream = allclose.stream(xtol=1)
+    a_buffer, b_buffer = np.empty(5), np.empty(5)
+    for i in range(0, 20, 5):
+        a_buffer[:] = y[i : i + 5]
+        b_buffer[:] = x[i : i + 5]
+        stream.update(a_buffer, b_buffer)
+    assert stream.result()
+
+
+@pytest.mark.parametrize("equal_nan", [False, True])
+@pytest.mark.parametrize("dtype", ["float32", "float64", "complex128", "int32"])
+def test_nonfinite(equal_nan, dtype, allclose):
+    rng = np.random.RandomState(11)
+    values = np.array([0, 1e-9, 1, -1, np.inf, -np.inf, np.nan])
+    if np.dtype(dtype).kind == "i":
+        values = np.array([0, 1, -1, 2**31 - 1, -(2**31)])
+
+    a = rng.choice(values, size=(200, 2)).astype(dtype)
+    b = rng.choice(values, size=(200, 2)).astype(dtype)
+    nan_b = np.where(np.isinf(b), np.nan, b)  # infinities in only one array
+    for x, y in [(a, b), (a, a), (a, a[0]), (a, 1), (a.real, b.real), (a, nan_b)]:
+        expected = np.isclose(x, y, equal_nan=equal_nan)
+        assert allclose(x, y, equal_nan=equal_nan, print_fail=0) == expected.all()
+
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        close = _isclose(x, y, 1e-5, 1e-8, 0, equal_nan, _finite(x), _finite(y))
+        assert np.array_equal(close, expected)
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_isclose_chunks(order):
+    rng = np.random.RandomState(12)
+    values = np.array([0, 1e-9, 1, -1, np.inf, -np.inf, np.nan])
+    a = np.asarray(rng.choice(values, size=(30, 7)), order=order)
+    b = np.asarray(rng.choice(values, size=(30, 7)), order=order)
+    rows, shifted = slice(1, None), slice(None, -1)
+
+    # chunks of 10 elements split rows (for C order) or columns (for F order)
+    for y in (b, b[:, :1]):
+        isclose = _isclose_rows(a, y, _finite(a), _finite(y), 1e-5, 1e-8, True, 10)
+        for y_rows in (rows, shifted):
+            assert np.array_equal(
+                isclose(rows, y_rows), np.isclose(a[rows], y[y_rows], equal_nan=True)
+            )
+
+
+def test_rmse_finite(allclose, request):
+    x = np.linspace(-1, 1, 11)
+    y = x + 0.01
+    x[3], y[3] = np.nan, np.nan
+    x[5], y[7] = np.inf, -np.inf
+
+    assert not allclose(y, x, atol=0.02, equal_nan=True)
+    properties = dict(request.node.user_properties)
+    assert "rmse" not in properties and "rmse_relative" not in properties
+    assert np.allclose(properties["rmse_finite"], 0.01)
+
+    stream = allclose.stream(atol=0.02, equal_nan=True)
+    for i in range(0, 11, 4):
+        stream.update(y[i : i + 4], x[i : i + 4])
+    assert not stream.result()
+    name, val = request.node.user_properties[-1]
+    assert name == "rmse_finite" and np.allclose(val, 0.01)
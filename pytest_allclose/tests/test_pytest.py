@@ -1,5 +1,6 @@
 # pylint: disable=missing-docstring
 
+import json
 import re
 from textwrap import dedent
 
@@ -160,3 +161,339 @@ def test_bad_override_parameter(testdir):
     result = testdir.runpytest("-v")
     outcomes = result.parseoutcomes()
     assert outcomes.get("passed", 0) == 0 and outcomes.get("errors", 0) == 1
+
+
+def test_defer_unchecked_failure(testdir):
+    testdir.makeconftest(
+        dedent(
+            """\
+            def pytest_runtest_logreport(report):
+                if report.when == "teardown":
+                    names = [name for name, _ in report.user_properties]
+                    with open(report.nodeid.split("::")[-1] + ".txt", "w") as f:
+                        f.write(" ".join(names))
+            """
+        )
+    )
+
+    testdir.makefile(
+        ".py",
+        test_defer_unchecked_failure=dedent(
+            """\
+            import numpy as np
+            import pytest
+
+            def test_unchecked(allclose):
+                x = np.linspace(-1, 1)
+                allclose.defer(x, x)
+                allclose.defer(x + 1, x)
+
+            def test_checked(allclose):
+                x = np.linspace(-1, 1)
+                assert not allclose.defer(x + 1, x)
+
+            def test_unchecked_error(allclose):
+                x = np.linspace(-1, 1)
+                allclose.defer(x + 1, x)
+                allclose.defer(x, x[:3])
+                allclose.defer(x + 0.001, x, atol=0.002)
+
+            def test_checked_error(allclose):
+                x = np.linspace(-1, 1)
+                with pytest.raises(ValueError):
+                    assert allclose.defer(x, x[:3])
+            """
+        ),
+    )
+
+    result = testdir.runpytest("-v")
+    outcomes = result.parseoutcomes()
+    assert outcomes.get("passed", 0) == 4 and outcomes.get("errors", 0) == 2
+    result.stdout.fnmatch_lines(
+        [
+            "*1 deferred allclose comparison(s) failed:",
+            "*test_defer_unchecked_failure.py:7",
+            "*2 deferred allclose comparison(s) failed:",
+            "*test_defer_unchecked_failure.py:15",
+            "*test_defer_unchecked_failure.py:16 (ValueError: *)",
+        ]
+    )
+
+    # comparisons after the error are still recorded
+    names = testdir.tmpdir.join("test_unchecked_error.txt").read().split()
+    assert names.count("rmse") == 2
+
+
+def test_defer_rmse_output(testdir):
+    testdir.makeconftest(
+        dedent(
+            """\
+            from pytest_allclose import report_rmses
+
+            def pytest_terminal_summary(terminalreporter):
+                report_rmses(terminalreporter, relative=False)
+            """
+        )
+    )
+
+    testdir.makefile(
+        ".py",
+        test_defer_rmse_output=dedent(
+            """\
+            import numpy as np
+
+            def test_rmse(allclose):
+                x = np.linspace(-1, 1)
+                allclose.defer(x + 0.001, x, atol=0.002)
+                allclose.defer(x + 0.003, x, atol=0.004)
+            """
+        ),
+    )
+
+    result = testdir.runpytest("-v")
+    assert assert_all_passed(result) == 1
+    result.stdout.fnmatch_lines(["mean RMSE: 0.00200 +/- 0.0010 (std)"])
+
+
+@pytest.mark.parametrize("disk", [False, True])
+def test_allclose_reference_cache(disk, testdir):
+    testdir.makeini(
+        dedent(
+            """\
+            [pytest]
+            allclose_reference_size = 1000
+            allclose_reference_disk = {disk}
+            """.format(
+                disk=disk
+            )
+        )
+    )
+
+    testdir.makefile(
+        ".py",
+        test_allclose_reference_cache=dedent(
+            """\
+            import numpy as np
+            import pytest
+
+            def reference(n):
+                with open("calls.txt", "a") as f:
+                    f.write("%d\\n" % n)
+                return np.ones(n)
+
+            @pytest.mark.parametrize("i", range(3))
+            def test_small(i, allclose, allclose_reference):
+                assert allclose(allclose_reference(reference, 10), np.ones(10))
+
+            @pytest.mark.parametrize("i", range(2))
+            def test_big(i, allclose, allclose_reference):
+                # larger than `allclose_reference_size`, so never kept in memory
+                assert allclose(allclose_reference(reference, 1000), np.ones(1000))
+            """
+        ),
+    )
+
+    for _ in range(2):
+        result = testdir.runpytest("-v")
+        assert assert_all_passed(result) == 5
+
+    calls = testdir.tmpdir.join("calls.txt").read().split()
+    assert calls == (["10", "1000"] if disk else ["10", "1000", "1000"] * 2)
+
+
+def test_allclose_reference(testdir):
+    testdir.makeini("[pytest]\nallclose_reference_disk = false\n")
+    testdir.makefile(
+        ".py",
+        test_allclose_reference=dedent(
+            """\
+            import numpy as np
+            import pytest
+
+            def expensive_reference(x, scale=1.0):
+                with open("calls.txt", "a") as f:
+                    f.write("%s\\n" % scale)
+                return scale * np.sin(x)
+
+            @pytest.mark.parametrize("offset", [0.001, 0.002])
+            def test_reference(offset, allclose, allclose_reference):
+                x = np.linspace(-1, 1)
+                b = allclose_reference(expensive_reference, x, scale=2.0)
+
+                assert not b.flags.writeable
+                with pytest.raises(ValueError):
+                    b[0] = 1
+
+                assert allclose(b + offset, 2 * np.sin(x), atol=offset + 1e-8)
+                assert not allclose(b + offset, 2 * np.sin(x), atol=offset / 2)
+
+                with pytest.raises(TypeError, match="Cannot hash argument"):
+                    allclose_reference(expensive_reference, x, scale=object())
+            """
+        ),
+    )
+
+    result = testdir.runpytest("-v")
+    assert assert_all_passed(result) == 2
+    assert testdir.tmpdir.join("calls.txt").read().split() == ["2.0"]
+
+
+def test_allclose_reference_identity(testdir):
+    testdir.makeini("[pytest]\nallclose_reference_disk = false\n")
+    testdir.makefile(
+        ".py",
+        test_allclose_reference_identity=dedent(
+            """\
+            import functools
+
+            import numpy as np
+            import pytest
+
+            def scaled_reference(x, k=1):
+                return k * x
+
+            def make_scaled_reference(k):
+                def reference(x):
+                    return k * x
+
+                return reference
+
+            def test_identity(allclose_reference):
+                x = np.arange(3.0)
+                for k in (2, 3):
+                    for func in (
+                        functools.partial(scaled_reference, k=k),
+                        make_scaled_reference(k),
+                    ):
+                        assert np.array_equal(allclose_reference(func, x), k * x)
+
+                def default_reference(x, k=4):
+                    return k * x
+
+                assert np.array_equal(allclose_reference(default_reference, x), 4 * x)
+
+                callables = (np.sin, type("C", (), {"__call__": scaled_reference})())
+                for func in callables:
+                    with pytest.raises(TypeError, match="Cannot identify callable"):
+                        allclose_reference(func, x)
+
+            class Simulator:
+                def __init__(self):
+                    self.output = np.arange(3.0)
+
+            simulator = Simulator()
+
+            def simulated_reference():
+                # returns a buffer that the simulator reuses (and that is not hashed)
+                return simulator.output
+
+            def test_returned_array(allclose_reference):
+                reference = allclose_reference(simulated_reference)
+                assert not reference.flags.writeable
+
+                # the returned array is not made read-only, and can be modified
+                # without changing the cached reference
+                assert simulator.output.flags.writeable
+                simulator.output[0] = 100
+                for x in (reference, allclose_reference(simulated_reference)):
+                    assert np.array_equal(x, [0, 1, 2])
+            """
+        ),
+    )
+
+    result = testdir.runpytest("-v")
+    assert assert_all_passed(result) == 2
+
+
+def test_allclose_reference_globals(testdir):
+    # changing a global variable used by the reference function invalidates
+    # references cached on disk
+    for scale in ("1.0", "2.0", "1.0"):
+        testdir.makefile(
+            ".py",
+            test_allclose_reference_globals=dedent(
+                """\
+                import numpy as np
+
+                SCALE = {scale}
+
+                def reference(x):
+                    with open("calls.txt", "a") as f:
+                        f.write("%s\\n" % SCALE)
+                    return SCALE * x
+
+                def test_globals(allclose, allclose_reference):
+                    x = np.arange(3.0)
+                    assert allclose(allclose_reference(reference, x), SCALE * x)
+                """.format(
+                    scale=scale
+                )
+            ),
+        )
+        result = testdir.runpytest("-v")
+        assert assert_all_passed(result) == 1
+
+    assert testdir.tmpdir.join("calls.txt").read().split() == ["1.0", "2.0"]
+
+
+@pytest.mark.parametrize("xdist", [False, True])
+def test_allclose_log(xdist, testdir):
+    testdir.makeini(
+        dedent(
+            """\
+            [pytest]
+            allclose_tolerances =
+                test_log[1] atol=0.1
+                test_log[1] atol=1e-8
+            """
+        )
+    )
+
+    testdir.makefile(
+        ".py",
+        test_allclose_log=dedent(
+            """\
+            import numpy as np
+            import pytest
+
+            @pytest.mark.parametrize("i", range(4))
+            def test_log(i, allclose):
+                x = np.linspace(-1, 1, 10, dtype=np.float32)
+                assert allclose(x + 0.01, x, atol=0.02)
+                assert not allclose.defer(x + 0.01 * (x > 0), x, record_rmse=False)
+            """
+        ),
+    )
+
+    args = []
+    if xdist:
+        pytest.importorskip("xdist")
+        args = ["-n", "2"]
+
+    # stale worker logs are removed, and the log is overwritten
+    testdir.tmpdir.join("log.jsonl.gw5").write("{}\n")
+    for _ in range(2):
+        result = testdir.runpytest("--allclose-log=log.jsonl", *args)
+        assert assert_all_passed(result) == 4
+
+    assert [p.basename for p in testdir.tmpdir.listdir("log.jsonl*")] == ["log.jsonl"]
+    with testdir.tmpdir.join("log.jsonl").open() as f:
+        records = sorted(
+            (json.loads(line) for line in f), key=lambda r: (r["nodeid"], r["index"])
+        )
+
+    assert len(records) == 8
+    for i in range(4):
+        first, second = records[2 * i : 2 * i + 2]
+        assert first["nodeid"] == "test_allclose_log.py::test_log[%d]" % i
+        assert first["nodeid"] == second["nodeid"]
+        assert first["index"] == 0 and second["index"] == 1
+        assert first["shape"] == [[10], [10]]
+        assert first["dtype"] == ["float32", "float32"]
+        assert first["tolerances"]["atol"] == (0.1 if i == 1 else 0.02)
+        assert first["passed"] and first["n_failures"] == 0
+        assert np.allclose(first["rmse"], 0.01)
+
+        assert second["tolerances"]["atol"] == 1e-8
+        assert not second["passed"] and second["n_failures"] == 5
+        assert second["rmse"] is None
@@ -39,13 +39,17 @@ docs_req = [
     "numpydoc>=0.9.2",
     "sphinx",
 ]
-optional_req = []
+optional_req = [
+    "pandas",
+    "xarray",
+]
 tests_req = [
     "codespell",
     "coverage>=4.3",
     "flake8",
     "gitlint",
     "pylint",
+    "pytest-xdist",
 ]
 
 setup(